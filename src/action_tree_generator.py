@@ -3,8 +3,9 @@
 
 import json
 import time
+import orjson
 import requests
-from typing import Union, Dict, Any
+from typing import Union, Dict, Any, Optional
 import os
 
 class ActionTreeGenerator:
@@ -29,6 +30,7 @@ class ActionTreeGenerator:
         api_key: str,
         model: str = "x-ai/grok-4.1-fast:free",
         base_url: str = "https://openrouter.ai/api/v1/chat/completions",
+        session: Optional[requests.Session] = None,
     ) -> None:
         """
         Инициализация генератора.
@@ -37,10 +39,12 @@ class ActionTreeGenerator:
             api_key: OpenRouter API ключ (str)
             model: Название модели для использования (str)
             base_url: URL OpenRouter API (str)
+            session: HTTP-сессия для переиспользования соединений (Optional[requests.Session])
         """
         self.model: str = model
         self.api_key: str = api_key
         self.base_url: str = base_url
+        self.session: requests.Session = session or requests.Session()
 
     # ---------- Вспомогательные методы (приватные) ----------
 
@@ -61,7 +65,7 @@ class ActionTreeGenerator:
         if isinstance(action_tree, dict):
             return action_tree
         elif isinstance(action_tree, str):
-            return json.loads(action_tree)
+            return orjson.loads(action_tree)
         else:
             raise TypeError(f"action_tree должен быть str или dict, получен {type(action_tree)}")
 
@@ -84,7 +88,7 @@ class ActionTreeGenerator:
             {
                 "role": "user",
                 "content": "Вот дерево всех возможных действий на сайте:\n"
-                           + json.dumps(action_tree, ensure_ascii=False),
+                           + orjson.dumps(action_tree).decode(),
             },
         ]
 
@@ -119,10 +123,10 @@ class ActionTreeGenerator:
             json.JSONDecodeError: Если оба варианта парсинга не сработали
         """
         try:
-            return json.loads(content)
-        except json.JSONDecodeError:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
             try:
-                return json.loads(content.encode().decode("unicode_escape"))
+                return orjson.loads(content.encode().decode("unicode_escape"))
             except Exception as e:
                 raise json.JSONDecodeError(
                     f"Не удалось распарсить JSON даже с fallback: {str(e)}",
@@ -154,15 +158,15 @@ class ActionTreeGenerator:
             "Content-Type": "application/json",
         }
 
-        response: requests.Response = requests.post(
+        response: requests.Response = self.session.post(
             self.base_url,
             headers=headers,
-            json=payload,
+            data=orjson.dumps(payload),
             timeout=120,
         )
         response.raise_for_status()
 
-        data: Dict[str, Any] = response.json()
+        data: Dict[str, Any] = orjson.loads(response.content)
         
         # Проверяем ошибки от OpenRouter
         if "error" in data:
@@ -214,9 +218,9 @@ class ActionTreeGenerator:
 
         if verbose:
             print("🔄 Отправка запроса к модели...")
-        start: float = time.time()
+        start: float = time.perf_counter()
         raw_content: str = self._make_api_call(messages)
-        elapsed: float = time.time() - start
+        elapsed: float = time.perf_counter() - start
         if verbose:
             print(f"⏱️  Время запроса: {elapsed:.2f} сек")
 
@@ -1,8 +1,6 @@
 # analyzer.py - Site Analysis and Task Tree Generation
 
-import json
 import os
-import sys
 import logging
 import sqlite3
 from datetime import datetime
@@ -12,11 +10,16 @@ import argparse
 from typing import Dict, Any, List, Optional, Union
 import uuid
 
+import orjson
+import requests
 from peewee import (
-    Model, SqliteDatabase, AutoField, TextField, IntegerField
+    Model, SqliteDatabase, AutoField, TextField, IntegerField, chunked
 )
 from action_tree_generator import ActionTreeGenerator
+from db_common import RATING_COUNT_TRIGGERS, SQLITE_PRAGMAS
+from download_html import download_urls, save_file_list
 from intent_extracter import process_instructions_pipeline
+from llm_http import llm_http_adapter
 
 from dotenv import load_dotenv  # pip install python-dotenv
 
@@ -37,9 +40,43 @@ DEEPSEEK_API_URL: str = "https://api.deepseek.com/v1/chat/completions"
 
 
 
+# Fallback-задачи строятся один раз при импорте и переиспользуются
+FALLBACK_TASKS: List[Dict[str, Any]] = [
+    {
+        "id": "browse_catalog",
+        "name": "Просмотр каталога товаров",
+        "description": "Навигация по категориям и поиск товаров",
+        "category": "Навигация",
+        "complexity": "low",
+        "elements": ["#catalog", ".categories-grid", "#search-input"]
+    },
+    {
+        "id": "add_to_cart",
+        "name": "Добавление товара в корзину",
+        "description": "Выбор товара и добавление в корзину",
+        "category": "Покупки",
+        "complexity": "medium",
+        "elements": [".product-card", "#cart-count"]
+    }
+]
+
+
 db: SqliteDatabase | None = None
 
 
+def dumps_json(obj: Any) -> str:
+    """
+    Сериализация в JSON-строку для TEXT-колонок через orjson
+
+    Args:
+        obj: Сериализуемый объект (Any)
+
+    Returns:
+        JSON в UTF-8 без экранирования не-ASCII символов (str)
+    """
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
 # ---------- модели Peewee ----------
 
 class BaseModel(Model):
@@ -123,6 +160,18 @@ class ChatHistory(BaseModel):
         table_name = "chat_history"
 
 
+# модели, которые привязываются к базе при создании DatabaseManager:
+# при объявлении классов db ещё None
+MODELS = [
+    TasksTrees,
+    InstructionsIntents,
+    Instructions,
+    InstructionRatings,
+    UserSessions,
+    ChatHistory,
+]
+
+
 # ---------- DatabaseManager на Peewee ----------
 
 class DatabaseManager:
@@ -137,7 +186,8 @@ class DatabaseManager:
         self.db_path: str = db_path
 
         # инициализируем peewee-базу
-        db = SqliteDatabase(self.db_path, pragmas={"foreign_keys": 1})
+        db = SqliteDatabase(self.db_path, pragmas=SQLITE_PRAGMAS)
+        db.bind(MODELS)
         db.connect(reuse_if_open=True)
 
         self.init_database()
@@ -163,32 +213,95 @@ class DatabaseManager:
     def init_database(self) -> None:
         """Инициализация структуры базы данных"""
 
-        # создаём таблицы, если их нет
-        db.create_tables(
-            [
-                TasksTrees,
-                InstructionsIntents,
-                Instructions,
-                InstructionRatings,
-                UserSessions,
-                ChatHistory,
-            ],
-            safe=True,
-        )
+        # таблицы и индексы создаём одной транзакцией — один коммит вместо
+        # отдельного на каждый DDL-запрос
+        with db.atomic():
+            # создаём таблицы, если их нет
+            db.create_tables(MODELS, safe=True)
+
+            # индексы (peewee не знает о них, поэтому создаём сырыми запросами один раз)
+            # (task_id, usage_count DESC) отдаёт самую используемую инструкцию задачи
+            # без сортировки; заменяет одноколоночный индекс по task_id
+            db.execute_sql("DROP INDEX IF EXISTS idx_instructions_task_id")
+            db.execute_sql(
+                "CREATE INDEX IF NOT EXISTS idx_instructions_task_usage "
+                "ON instructions(task_id, usage_count DESC)"
+            )
+            db.execute_sql(
+                "CREATE INDEX IF NOT EXISTS idx_instructions_usage ON instructions(usage_count)"
+            )
+            # одна оценка на (инструкция, сессия): API проверяет повтор в самой
+            # вставке, а уникальный индекс отсекает гонку параллельных запросов;
+            # старые дубли удаляем, иначе индекс не построится
+            db.execute_sql("DROP INDEX IF EXISTS idx_ratings_instruction_id")
+            db.execute_sql("DROP INDEX IF EXISTS idx_ratings_instruction_session")
+            db.execute_sql(
+                "DELETE FROM instruction_ratings WHERE user_session IS NOT NULL "
+                "AND id NOT IN (SELECT MIN(id) FROM instruction_ratings "
+                "GROUP BY instruction_id, user_session)"
+            )
+            db.execute_sql(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_ratings_instruction_session_unique "
+                "ON instruction_ratings(instruction_id, user_session)"
+            )
+            # «популярные инструкции» сортируются по usage_count + likes * 5 —
+            # индекс по выражению отдаёт топ без сортировки всей таблицы
+            db.execute_sql(
+                "CREATE INDEX IF NOT EXISTS idx_instructions_popularity "
+                "ON instructions((usage_count + likes * 5) DESC)"
+            )
+            # счётчики likes/dislikes ведёт сама БД (триггеры на оценках)
+            for trigger_sql in RATING_COUNT_TRIGGERS:
+                db.execute_sql(trigger_sql)
+            # история чата: фильтр по сессии и сортировка по времени одним
+            # индексом; заменяет одноколоночный индекс по session_id
+            db.execute_sql("DROP INDEX IF EXISTS idx_chat_history_session_id")
+            db.execute_sql(
+                "CREATE INDEX IF NOT EXISTS idx_chat_history_session_created "
+                "ON chat_history(session_id, created_at DESC)"
+            )
 
-        # индексы (peewee не знает о них, поэтому создаём сырыми запросами один раз)
-        db.execute_sql(
-            "CREATE INDEX IF NOT EXISTS idx_instructions_task_id ON instructions(task_id)"
-        )
-        db.execute_sql(
-            "CREATE INDEX IF NOT EXISTS idx_instructions_usage ON instructions(usage_count)"
-        )
-        db.execute_sql(
-            "CREATE INDEX IF NOT EXISTS idx_ratings_instruction_id ON instruction_ratings(instruction_id)"
-        )
-        db.execute_sql(
-            "CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history(session_id)"
-        )
+            # полнотекстовый индекс для /api/search-instructions; tokenizer trigram
+            # ищет подстроку (как прежний LIKE '%q%'), но по индексу, а не сканом
+            # всех JSON-колонок. rowid совпадает с rowid строки instructions
+            db.execute_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS instructions_fts USING fts5("
+                "instruction_id UNINDEXED, task_id, user_query, task_data, steps, "
+                "tokenize='trigram')"
+            )
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS instructions_fts_insert "
+                "AFTER INSERT ON instructions BEGIN "
+                "INSERT INTO instructions_fts(rowid, instruction_id, task_id, user_query, task_data, steps) "
+                "VALUES (new.rowid, new.id, new.task_id, new.user_query, new.task_data_json, new.steps_json); "
+                "END"
+            )
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS instructions_fts_delete "
+                "AFTER DELETE ON instructions BEGIN "
+                "DELETE FROM instructions_fts WHERE rowid = old.rowid; "
+                "END"
+            )
+            db.execute_sql(
+                "CREATE TRIGGER IF NOT EXISTS instructions_fts_update "
+                "AFTER UPDATE OF task_id, user_query, task_data_json, steps_json ON instructions BEGIN "
+                "DELETE FROM instructions_fts WHERE rowid = old.rowid; "
+                "INSERT INTO instructions_fts(rowid, instruction_id, task_id, user_query, task_data, steps) "
+                "VALUES (new.rowid, new.id, new.task_id, new.user_query, new.task_data_json, new.steps_json); "
+                "END"
+            )
+            # индекс перестраиваем целиком: так он заполняется для уже
+            # существующих строк и не расходится с таблицей после VACUUM
+            db.execute_sql("DELETE FROM instructions_fts")
+            db.execute_sql(
+                "INSERT INTO instructions_fts(rowid, instruction_id, task_id, user_query, task_data, steps) "
+                "SELECT rowid, id, task_id, user_query, task_data_json, steps_json FROM instructions"
+            )
+
+        # статистика планировщика для созданных индексов: без неё SQLite
+        # может выбрать индекс по session_id и сортировать историю чата отдельно
+        db.execute_sql("PRAGMA analysis_limit=1000")
+        db.execute_sql("ANALYZE")
 
         logger.info("Database initialized successfully")
 
@@ -203,14 +316,14 @@ class DatabaseManager:
         """
         application = tasks_tree_js.get("application", "EcoStore")
         analyzed_at = tasks_tree_js.get("analyzed_at", datetime.now().isoformat())
-        tasks_json = json.dumps(tasks_tree_js.get("root_task", []), ensure_ascii=False)
+        tasks_json = dumps_json(tasks_tree_js.get("root_task", []))
 
-        TasksTrees.create(
+        TasksTrees.insert(
             application=application,
             analyzed_at=analyzed_at,
             tasks_json=tasks_json,
             created_at=datetime.now().isoformat(),
-        )
+        ).execute()
 
         logger.info(
             f"Tasks tree saved for application: {tasks_tree_js.get('application', 'EcoStore')}"
@@ -225,16 +338,14 @@ class DatabaseManager:
         """
         application = instructions_js.get("application", "EcoStore")
         analyzed_at = instructions_js.get("analyzed_at", datetime.now().isoformat())
-        instructions = json.dumps(
-            instructions_js.get("instructions", []), ensure_ascii=False
-        )
+        instructions = dumps_json(instructions_js.get("instructions", []))
 
-        InstructionsIntents.create(
+        InstructionsIntents.insert(
             application=application,
             analyzed_at=analyzed_at,
             instructions=instructions,
             created_at=datetime.now().isoformat(),
-        )
+        ).execute()
 
         logger.info(
             f"instructions saved for application: {instructions_js.get('application', 'EcoStore')}"
@@ -247,62 +358,78 @@ class DatabaseManager:
         Args:
             instruction_data: Данные инструкции (Dict[str, Any])
         """
-        now_iso = datetime.now().isoformat()
-
-        Instructions.insert(
-            id=instruction_data["id"],
-            task_id=instruction_data["task_id"],
-            task_data_json=json.dumps(
-                instruction_data.get("task_data", {}), ensure_ascii=False
-            ),
-            steps_json=json.dumps(
-                instruction_data.get("steps", []), ensure_ascii=False
-            ),
-            user_query=instruction_data.get("user_query", ""),
-            context_json=json.dumps(
-                instruction_data.get("context", {}), ensure_ascii=False
-            ),
-            timestamp=instruction_data["timestamp"],
-            usage_count=instruction_data.get("usage_count", 0),
-            last_used=instruction_data.get("last_used"),
-            file_paths_json=json.dumps(
-                instruction_data.get("file_paths", {}), ensure_ascii=False
-            ),
-            likes=instruction_data.get("likes", 0),
-            dislikes=instruction_data.get("dislikes", 0),
-            created_at=now_iso,
-            updated_at=now_iso,
-        ).on_conflict(
-            conflict_target=[Instructions.id],
-            preserve=[
-                Instructions.created_at,
-            ],
-            update={
-                Instructions.task_id: instruction_data["task_id"],
-                Instructions.task_data_json: json.dumps(
-                    instruction_data.get("task_data", {}), ensure_ascii=False
-                ),
-                Instructions.steps_json: json.dumps(
-                    instruction_data.get("steps", []), ensure_ascii=False
-                ),
-                Instructions.user_query: instruction_data.get("user_query", ""),
-                Instructions.context_json: json.dumps(
-                    instruction_data.get("context", {}), ensure_ascii=False
-                ),
-                Instructions.timestamp: instruction_data["timestamp"],
-                Instructions.usage_count: instruction_data.get("usage_count", 0),
-                Instructions.last_used: instruction_data.get("last_used"),
-                Instructions.file_paths_json: json.dumps(
-                    instruction_data.get("file_paths", {}), ensure_ascii=False
-                ),
-                Instructions.likes: instruction_data.get("likes", 0),
-                Instructions.dislikes: instruction_data.get("dislikes", 0),
-                Instructions.updated_at: now_iso,
-            },
-        ).execute()
+        self._upsert_instructions([instruction_data])
 
         logger.info(f"Instruction saved: {instruction_data['id']}")
 
+    def save_instructions_bulk(self, instructions: List[Dict[str, Any]]) -> None:
+        """
+        Пакетное сохранение инструкций: многострочные INSERT ... ON CONFLICT
+        в одной транзакции вместо отдельного запроса и коммита на каждую
+
+        Args:
+            instructions: Данные инструкций (List[Dict[str, Any]])
+        """
+        if not instructions:
+            return
+
+        self._upsert_instructions(instructions)
+
+        logger.info(f"Instructions saved: {len(instructions)}")
+
+    def _upsert_instructions(self, instructions: List[Dict[str, Any]]) -> None:
+        """
+        INSERT ... ON CONFLICT(id) DO UPDATE: существующая строка обновляется
+        на месте значениями из EXCLUDED (каждая колонка сериализуется один раз),
+        created_at сохраняется
+
+        Args:
+            instructions: Данные инструкций (List[Dict[str, Any]])
+        """
+        now_iso = datetime.now().isoformat()
+        # у инструкций одного анализа общий context (весь DOM) — сериализуем
+        # каждый объект один раз
+        serialized: Dict[int, str] = {}
+
+        def dumps_once(obj: Any) -> str:
+            key = id(obj)
+            if key not in serialized:
+                serialized[key] = dumps_json(obj)
+            return serialized[key]
+
+        rows = [
+            {
+                "id": item["id"],
+                "task_id": item["task_id"],
+                "task_data_json": dumps_json(item.get("task_data", {})),
+                "steps_json": dumps_json(item.get("steps", [])),
+                "user_query": item.get("user_query", ""),
+                "context_json": dumps_once(item.get("context", {})),
+                "timestamp": item["timestamp"],
+                "usage_count": item.get("usage_count", 0),
+                "last_used": item.get("last_used"),
+                "file_paths_json": dumps_json(item.get("file_paths", {})),
+                "likes": item.get("likes", 0),
+                "dislikes": item.get("dislikes", 0),
+                "created_at": now_iso,
+                "updated_at": now_iso,
+            }
+            for item in instructions
+        ]
+
+        # при конфликте обновляем всё, кроме id и created_at
+        preserve = [
+            field for field in Instructions._meta.sorted_fields
+            if field is not Instructions.id and field is not Instructions.created_at
+        ]
+        # 14 параметров на строку — пачки по 500 укладываются в лимит SQLite
+        with db.atomic():
+            for batch in chunked(rows, 500):
+                Instructions.insert_many(batch).on_conflict(
+                    conflict_target=[Instructions.id],
+                    preserve=preserve,
+                ).execute()
+
 
 
 class DOMAnalyzer:
@@ -324,16 +451,13 @@ class DOMAnalyzer:
         try:
             logger.info(f"Starting DOM analysis for URLs: {urls}")
 
-            # Скачиваем HTML файлы
-            download_result = subprocess.run(
-                [sys.executable, "download_html.py"],
-                capture_output=True,
-                text=True,
-                errors='replace'
-            )
-
-            if download_result.returncode != 0:
-                error_msg: str = download_result.stderr or "Unknown download error"
+            # Скачиваем HTML файлы в этом же процессе, без запуска
+            # отдельного интерпретатора на каждый анализ
+            try:
+                html_files: List[str] = download_urls(urls)
+                save_file_list(html_files)
+            except Exception as e:
+                error_msg: str = str(e) or "Unknown download error"
                 logger.error(f"Download failed: {error_msg}")
                 return {"error": f"Download failed: {error_msg}"}
 
@@ -351,8 +475,8 @@ class DOMAnalyzer:
                 return {"error": f"DOM analysis failed: {error_msg}"}
 
             # Читаем результат анализа
-            with open('dom_analysis.json', 'r', encoding='utf-8') as f:
-                dom_analysis: Dict[str, Any] = json.load(f)
+            with open('dom_analysis.json', 'rb') as f:
+                dom_analysis: Dict[str, Any] = orjson.loads(f.read())
 
             logger.info("DOM analysis completed successfully")
             return dom_analysis
@@ -374,7 +498,10 @@ class DeepSeekClient:
         """
         self.api_key: str = api_key
         self.api_url: str = api_url
-        self.gen: ActionTreeGenerator = ActionTreeGenerator(api_key=api_key)
+        # Одна сессия на оба этапа генерации: соединения с API переиспользуются
+        self.session: requests.Session = requests.Session()
+        self.session.mount("https://", llm_http_adapter())
+        self.gen: ActionTreeGenerator = ActionTreeGenerator(api_key=api_key, session=self.session)
 
     def generate_tasks_tree(
         self,
@@ -434,7 +561,8 @@ class DeepSeekClient:
             # ActionTreeGenerator.generate_dict() принимает dict или str и возвращает dict
             tasks_tree: Dict[str, Any] = process_instructions_pipeline(
                 tree_dict=tasks_tree,
-                api_key=api_key
+                api_key=api_key,
+                session=self.session
             )
 
             return tasks_tree
@@ -486,7 +614,7 @@ class InstructionManager:
         """
         self.db_manager.save_instructions(instructions)
 
-    def save_instruction(
+    def build_instruction(
         self,
         task_id: str,
         steps: List[str],
@@ -495,7 +623,7 @@ class InstructionManager:
         task_data: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """
-        Сохранение инструкции
+        Формирование данных новой инструкции (без записи в БД)
         
         Args:
             task_id: ID задачи (str)
@@ -505,12 +633,12 @@ class InstructionManager:
             task_data: Данные задачи (Optional[Dict[str, Any]])
             
         Returns:
-            Сохранённые данные инструкции (Dict[str, Any])
+            Данные инструкции (Dict[str, Any])
         """
         instruction_id: str = str(uuid.uuid4())
         timestamp: str = datetime.now().isoformat()
 
-        instruction_data: Dict[str, Any] = {
+        return {
             "id": instruction_id,
             "task_id": task_id,
             "task_data": task_data or {},
@@ -525,21 +653,55 @@ class InstructionManager:
             "dislikes": 0
         }
 
+    def save_instruction(
+        self,
+        task_id: str,
+        steps: List[str],
+        user_query: Optional[str] = None,
+        context: Optional[Dict[str, Any]] = None,
+        task_data: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Сохранение инструкции
+        
+        Args:
+            task_id: ID задачи (str)
+            steps: Список шагов (List[str])
+            user_query: Запрос пользователя (Optional[str])
+            context: Контекст (Optional[Dict[str, Any]])
+            task_data: Данные задачи (Optional[Dict[str, Any]])
+            
+        Returns:
+            Сохранённые данные инструкции (Dict[str, Any])
+        """
+        instruction_data = self.build_instruction(task_id, steps, user_query, context, task_data)
+
         self.db_manager.save_instruction(instruction_data)
         logger.info(f"Instruction saved for task: {task_id}")
         return instruction_data
 
+    def save_instructions_bulk(self, instructions: List[Dict[str, Any]]) -> None:
+        """
+        Пакетное сохранение инструкций
+        
+        Args:
+            instructions: Данные инструкций (List[Dict[str, Any]])
+        """
+        self.db_manager.save_instructions_bulk(instructions)
 
 
 
-def generate_instructions_recursive(task, dom_analysis, instruction_manager, instructions_accum):
-    # Генерация инструкции для текущей задачи
-    instruction_data = instruction_manager.save_instruction(
+
+def generate_instructions_recursive(task, dom_analysis, instruction_manager, instructions_accum, instructions_data):
+    # Генерация инструкции для текущей задачи; запись в БД — одним пакетом
+    # после обхода всего дерева (instructions_data)
+    instruction_data = instruction_manager.build_instruction(
         task_id=task["task_id"],
         task_data=task,
         steps = [],
         context=dom_analysis
     )
+    instructions_data.append(instruction_data)
     instructions_accum.append({
         "task_id": task["task_id"],
         "task_name": task["task_name"],
@@ -548,7 +710,7 @@ def generate_instructions_recursive(task, dom_analysis, instruction_manager, ins
 
     # Рекурсивно вызываем для дочерних задач
     for child_task in task.get("children", []):
-        generate_instructions_recursive(child_task, dom_analysis, instruction_manager, instructions_accum)
+        generate_instructions_recursive(child_task, dom_analysis, instruction_manager, instructions_accum, instructions_data)
 
 class SiteAnalyzer:
     """Главный класс для анализа сайта"""
@@ -617,7 +779,9 @@ class SiteAnalyzer:
             
             root_task = tasks_tree.get("root_task")
             if root_task:
-                generate_instructions_recursive(root_task, dom_analysis, self.instruction_manager, generated_instructions)
+                instructions_data: List[Dict[str, Any]] = []
+                generate_instructions_recursive(root_task, dom_analysis, self.instruction_manager, generated_instructions, instructions_data)
+                self.instruction_manager.save_instructions_bulk(instructions_data)
 
 
             result: Dict[str, Any] = {
@@ -639,6 +803,8 @@ class SiteAnalyzer:
     def _get_fallback_tasks_tree(self) -> Dict[str, Any]:
         """
         Fallback дерево задач если API недоступно
+
+        Список задач общий для всех вызовов (FALLBACK_TASKS) и не должен изменяться.
         
         Returns:
             Дерево задач (Dict[str, Any])
@@ -646,24 +812,7 @@ class SiteAnalyzer:
         return {
             "application": "EcoStore - Интернет-магазин",
             "analyzed_at": datetime.now().isoformat(),
-            "tasks": [
-                {
-                    "id": "browse_catalog",
-                    "name": "Просмотр каталога товаров",
-                    "description": "Навигация по категориям и поиск товаров",
-                    "category": "Навигация",
-                    "complexity": "low",
-                    "elements": ["#catalog", ".categories-grid", "#search-input"]
-                },
-                {
-                    "id": "add_to_cart",
-                    "name": "Добавление товара в корзину",
-                    "description": "Выбор товара и добавление в корзину",
-                    "category": "Покупки",
-                    "complexity": "medium",
-                    "elements": [".product-card", "#cart-count"]
-                }
-            ]
+            "tasks": FALLBACK_TASKS,
         }
 
 
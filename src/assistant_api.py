@@ -1,20 +1,34 @@
 # assistant_api.py - Боевой API ассистента с интеграцией InstructionAssistant
 
-import json
 import os
+import re
+import atexit
 import sys
-import uuid
+import time
+import queue
+import secrets
 import logging
 import sqlite3
+import threading
+import orjson
 from datetime import datetime
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from itertools import chain, islice
 from contextlib import contextmanager
-from flask import Flask, request, jsonify
+from concurrent.futures import Future
+from flask import Flask, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv 
 from peewee import (
-    Model, SqliteDatabase, TextField, IntegerField, DateTimeField,
-    AutoField
+    Model, TextField, IntegerField, DateTimeField,
+    AutoField, SQL, fn, Case, Select, Value, chunked,
+    IntegrityError, OperationalError,
 )
+from playhouse.pool import PooledSqliteDatabase
+
+from db_common import RATING_COUNT_TRIGGERS, SQLITE_PRAGMAS
 
 # Импорт InstructionAssistant
 from instruction_finder import InstructionAssistant
@@ -26,17 +40,173 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    JSON-провайдер Flask на orjson: jsonify и app.json.dumps сериализуют
+    ответы, а request.json разбирает тело запроса C-расширением вместо
+    stdlib json.
+
+    datetime передаются в default провайдера Flask, поэтому даты в ответах
+    остаются в прежнем формате (HTTP-date). Скаляры и массивы numpy (оценки
+    схожести из векторного поиска) сериализуются напрямую.
+    """
+
+    def _options(self):
+        options = (
+            orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_SERIALIZE_NUMPY
+        )
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        # orjson.JSONDecodeError наследует ValueError — Flask по-прежнему
+        # отвечает 400 на некорректное тело
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._options())
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app, origins=["*"])
 
 # Конфигурация базы данных
 DATABASE_PATH = "ai_assistant.db"
 
+# Число потоков WSGI-сервера: запросы обрабатываются параллельно, каждый
+# со своим соединением из пула
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "8"))
+
+# Максимальное число соединений в пуле БД: 2 на ядро (не больше 25),
+# но не меньше числа потоков сервера, чтобы поток не ждал соединения
+DB_POOL_SIZE = int(os.getenv(
+    "DB_POOL_SIZE",
+    max(WSGI_THREADS, min((os.cpu_count() or 1) * 2, 25)),
+))
+
+# Сколько поисков (эмбеддинг + вызовы LLM) может выполняться одновременно
+MAX_CONCURRENT_SEARCHES = int(os.getenv("MAX_CONCURRENT_SEARCHES", "4"))
+
+# Кэш готовых ответов ассистента: сколько запросов помнить и сколько секунд
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+
+# Кэш инструкций по ID задачи для /api/get-instruction: сколько задач помнить
+# и сколько секунд (новые инструкции пишет analyzer.py из другого процесса)
+INSTRUCTION_CACHE_SIZE = int(os.getenv("INSTRUCTION_CACHE_SIZE", "512"))
+INSTRUCTION_CACHE_TTL = float(os.getenv("INSTRUCTION_CACHE_TTL", "60"))
+
+# Сколько элементов списка читать до отправки заголовков потокового ответа
+STREAM_PREFETCH = int(os.getenv("STREAM_PREFETCH", "100"))
+
+# Сколько разобранных JSON-полей инструкций держать в памяти
+JSON_FIELD_CACHE_SIZE = int(os.getenv("JSON_FIELD_CACHE_SIZE", "512"))
+
+# Как часто (сек) записывать в БД активность одной и той же сессии
+SESSION_TOUCH_TTL = float(os.getenv("SESSION_TOUCH_TTL", "60"))
+
+# Сколько недавно записанных сессий помнить в памяти
+SESSION_CACHE_SIZE = 10000
+
+# Как часто (сек) записывать в БД накопленные счётчики использования инструкций
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+
+# Метка в очереди истории чата: фоновая запись дописывает всё до неё и
+# завершается (flush_chat_messages)
+CHAT_WRITER_STOP = object()
+
+# Как часто (сек) обновлять статистику планировщика SQLite (ANALYZE)
+DB_ANALYZE_INTERVAL = float(os.getenv("DB_ANALYZE_INTERVAL", "3600"))
+
+
+def index_tasks(tasks):
+    """
+    Индекс task_id -> узел дерева задач. Дерево вложенное (root_task с
+    children), поэтому обходится целиком один раз при загрузке, а поиск
+    задачи в запросе — обращение к словарю.
+    """
+    index = {}
+    stack = [tasks] if isinstance(tasks, dict) else list(tasks or [])
+    while stack:
+        task = stack.pop()
+        if "task_id" in task:
+            index.setdefault(task["task_id"], task)
+        stack.extend(task.get("children") or [])
+    return index
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей.
+    Ключи хранятся в порядке последнего обращения: сверх maxsize вытесняются
+    самые давние, устаревшие удаляются при чтении
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # ключ -> (time.monotonic() записи, значение)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Значение, если оно моложе ttl, иначе None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Сохраняет значение; самые давние ключи сверх maxsize вытесняются"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard_if(self, predicate):
+        """Удаляет записи, для значений которых predicate(value) истинно"""
+        with self._lock:
+            stale = [key for key, (_, value) in self._entries.items() if predicate(value)]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 # ==================== Database Manager ====================
 # ---------- Peewee DB/модели ----------
 
-db = SqliteDatabase(DATABASE_PATH, pragmas={"foreign_keys": 1})
+# Пул долгоживущих соединений: запрос берет соединение из пула и возвращает
+# его по завершении, вместо открытия нового соединения в каждом потоке
+db = PooledSqliteDatabase(
+    DATABASE_PATH,
+    max_connections=DB_POOL_SIZE,
+    stale_timeout=300,
+    timeout=10,
+    pragmas=SQLITE_PRAGMAS,
+    # соединения из пула переходят между потоками запросов
+    check_same_thread=False,
+)
 
 
 class BaseModel(Model):
@@ -85,6 +255,14 @@ class Instructions(BaseModel):
         table_name = "instructions"
 
 
+# Колонки инструкции для списков и поиска по задаче: без context_json —
+# это полный снимок DOM, он нужен только при запросе одной инструкции
+INSTRUCTION_LIST_FIELDS = tuple(
+    field for field in Instructions._meta.sorted_fields
+    if field is not Instructions.context_json
+)
+
+
 class InstructionRatings(BaseModel):
     id = AutoField()
     instruction_id = IntegerField()
@@ -119,6 +297,19 @@ class UserSessions(BaseModel):
 
 # ---------- Новый DatabaseManager на Peewee ----------
 
+@lru_cache(maxsize=JSON_FIELD_CACHE_SIZE)
+def load_json_field(raw):
+    """
+    Разбор JSON-колонки инструкции с кэшированием по исходной строке.
+
+    Инструкции меняются редко, а популярные/поиск разбирают одни и те же
+    steps_json/context_json на каждый запрос. Изменённая запись даёт новую
+    строку-ключ, поэтому явная инвалидация не нужна. Результат общий для всех
+    запросов — вызывающий код не должен его изменять.
+    """
+    return orjson.loads(raw)
+
+
 class DatabaseManager:
     """Менеджер базы данных SQLite (read-only для API, но с записью рейтингов и чата)"""
 
@@ -132,6 +323,25 @@ class DatabaseManager:
             raise FileNotFoundError(f"Database not found at {db_path}")
         # Peewee сам управляет подключениями; здесь можно просто проверить коннект
         db.connect(reuse_if_open=True)
+        # полнотекстовый индекс создаёт analyzer.py; на старой БД его может не быть
+        self.has_fts = db.table_exists("instructions_fts")
+        # последнее дерево задач: пишет его только analyzer.py (другой процесс),
+        # поэтому кэш сверяется с id последней строки tasks_trees
+        self._tasks_tree_cache = None
+        # счётчики likes/dislikes ведут триггеры; на БД, где analyzer.py их ещё
+        # не создал, создаём их сами — API пишет только строку оценки
+        with db.atomic():
+            for trigger_sql in RATING_COUNT_TRIGGERS:
+                db.execute_sql(trigger_sql)
+        # использования инструкций, ещё не записанные в БД: id -> число
+        self._pending_usage = Counter()
+        self._pending_usage_lock = threading.Lock()
+        self._usage_flusher = None
+        # инструкции по ID задачи для /api/get-instruction
+        self._instructions_by_task = TTLCache(INSTRUCTION_CACHE_SIZE, INSTRUCTION_CACHE_TTL)
+        # сообщения чата, ожидающие записи фоновым потоком (start_chat_writer)
+        self._chat_queue = queue.Queue()
+        self._chat_writer = None
 
     @contextmanager
     def get_connection(self):
@@ -144,9 +354,20 @@ class DatabaseManager:
                 db.connect()
             yield db
         finally:
-            # соединение оставляем открытым; peewee сам менеджит пул
+            # соединение возвращается в пул в конце запроса (teardown_request)
             pass
 
+    def refresh_planner_stats(self):
+        """
+        Обновление статистики планировщика (sqlite_stat1): по ней SQLite
+        выбирает индексы для поиска, популярных инструкций и истории чата.
+        analysis_limit ограничивает число просматриваемых строк индекса,
+        чтобы ANALYZE оставался дешёвым на растущей БД
+        """
+        with db.connection_context():
+            db.execute_sql("PRAGMA analysis_limit=1000")
+            db.execute_sql("ANALYZE")
+
     # ---------- методы с тем же интерфейсом ----------
 
     def get_latest_instructions_intents(self):
@@ -162,7 +383,7 @@ class DatabaseManager:
             if not row:
                 return None
 
-            instructions = json.loads(row.instructions)
+            instructions = orjson.loads(row.instructions)
             return {
                 "id": row.id,
                 "application": row.application,
@@ -173,25 +394,71 @@ class DatabaseManager:
                     else instructions
                 ),
             }
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.error("Failed to parse instructions JSON from DB")
             return None
 
-    def get_latest_tasks_tree(self):
-        """Получение последнего дерева задач из БД"""
-        row = (
+    def _latest_tasks_tree(self):
+        """
+        Последнее дерево задач из кэша. Запрос к БД — только за id последней
+        строки; tasks_json читается и разбирается заново, лишь когда id сменился.
+        """
+        latest_id = (
             TasksTrees
-            .select()
+            .select(TasksTrees.id)
             .order_by(TasksTrees.created_at.desc())
             .limit(1)
-            .first()
+            .scalar()
         )
-        if not row:
-            return {}
-        return {
+        if latest_id is None:
+            return None
+        cached = self._tasks_tree_cache
+        if cached is not None and cached["id"] == latest_id:
+            return cached
+        row = TasksTrees.get_by_id(latest_id)
+        cached = {
+            "id": row.id,
             "application": row.application,
             "analyzed_at": row.analyzed_at,
-            "tasks": json.loads(row.tasks_json),
+            "tasks_json": row.tasks_json,
+            "tasks": orjson.loads(row.tasks_json),
+        }
+        cached["tasks_by_id"] = index_tasks(cached["tasks"])
+        # присваивание ссылки атомарно; при гонке дерево просто загрузят дважды
+        self._tasks_tree_cache = cached
+        return cached
+
+    def get_latest_tasks_tree(self):
+        """Получение последнего дерева задач (tasks общий для всех запросов — не изменять)"""
+        cached = self._latest_tasks_tree()
+        if not cached:
+            return {}
+        return {
+            "application": cached["application"],
+            "analyzed_at": cached["analyzed_at"],
+            "tasks": cached["tasks"],
+        }
+
+    def get_task(self, task_id):
+        """Узел задачи из последнего дерева по task_id (общий объект — не изменять)"""
+        cached = self._latest_tasks_tree()
+        if not cached:
+            return None
+        return cached["tasks_by_id"].get(task_id)
+
+    def has_tasks_tree(self):
+        """Есть ли в БД хотя бы одно дерево задач (без загрузки самого дерева)"""
+        return TasksTrees.select().exists()
+
+    def get_latest_tasks_tree_raw(self):
+        """Последнее дерево задач с необработанным tasks_json (без json.loads)"""
+        cached = self._latest_tasks_tree()
+        if not cached:
+            return None
+        return {
+            "application": cached["application"],
+            "analyzed_at": cached["analyzed_at"],
+            "tasks_json": cached["tasks_json"],
         }
 
     def get_instruction(self, instruction_id):
@@ -205,65 +472,163 @@ class DatabaseManager:
         """Получение инструкции по ID задачи"""
         row = (
             Instructions
-            .select()
+            .select(*INSTRUCTION_LIST_FIELDS)
             .where(Instructions.task_id == task_id)
             .order_by(Instructions.usage_count.desc())
             .limit(1)
             .first()
         )
         if row:
-            return self._row_to_instruction_dict(row)
+            return self._row_to_instruction_dict(row, with_context=False)
+        return None
+
+    def get_instruction_by_task_id_raw(self, task_id):
+        """
+        Инструкция по ID задачи для ответа API: steps_json и file_paths_json
+        возвращаются как хранятся, без json.loads — их вставляют в ответ как есть.
+        Результат кэшируется на INSTRUCTION_CACHE_TTL секунд (общий объект —
+        не изменять). Оценка сбрасывает кэш инструкции; выбор самой
+        используемой инструкции задачи обновляется по истечении TTL
+        """
+        instruction = self._instructions_by_task.get(task_id)
+        if instruction is None:
+            instruction = self._load_instruction_by_task_id_raw(task_id)
+            if instruction is not None:
+                self._instructions_by_task.set(task_id, instruction)
+        return instruction
+
+    def _load_instruction_by_task_id_raw(self, task_id):
+        """Самая используемая инструкция задачи — чтение из БД"""
+        row = (
+            Instructions
+            .select(
+                Instructions.id,
+                Instructions.steps_json,
+                Instructions.file_paths_json,
+                Instructions.likes,
+                Instructions.dislikes,
+            )
+            .where(Instructions.task_id == task_id)
+            .order_by(Instructions.usage_count.desc())
+            .limit(1)
+            .first()
+        )
+        if row:
+            return {
+                "id": row.id,
+                "steps_json": row.steps_json or "[]",
+                "file_paths_json": row.file_paths_json or "{}",
+                "likes": row.likes,
+                "dislikes": row.dislikes,
+            }
         return None
 
-    def update_instruction_usage(self, instruction_id):
-        """Обновление счетчика использования инструкции"""
-        now_iso = datetime.now().isoformat()
+    def record_instruction_usage(self, instruction_id):
+        """
+        Учёт использования инструкции. Пока работает фоновая запись
+        (start_usage_flusher), счётчик копится в памяти и записывается
+        flush_instruction_usage(); без неё — сразу в БД
+        """
+        if self._usage_flusher is None:
+            self._apply_usage({instruction_id: 1})
+            return
+        with self._pending_usage_lock:
+            self._pending_usage[instruction_id] += 1
+
+    def flush_instruction_usage(self):
+        """Записывает накопленные использования инструкций одним UPDATE"""
+        with self._pending_usage_lock:
+            pending, self._pending_usage = self._pending_usage, Counter()
+        if not pending:
+            return
+        try:
+            with db.connection_context():
+                self._apply_usage(pending)
+        except Exception:
+            # не потерять счётчики: вернуть их к следующей записи
+            with self._pending_usage_lock:
+                self._pending_usage.update(pending)
+            raise
+
+    def start_usage_flusher(self, interval):
+        """Запускает фоновую запись счётчиков использования раз в interval секунд"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush_instruction_usage()
+                except Exception as e:
+                    logger.error(f"Error flushing instruction usage: {str(e)}")
+
+        self._usage_flusher = threading.Thread(target=loop, name="usage-flush", daemon=True)
+        self._usage_flusher.start()
+        # накопленное за последние секунды записывается и при остановке
+        atexit.register(self.flush_instruction_usage)
+
+    def _apply_usage(self, counts):
+        """UPDATE usage_count = usage_count + CASE id ... END для counts (id -> число)"""
+        now = datetime.now()
         (
             Instructions
             .update(
-                usage_count=Instructions.usage_count + 1,
-                last_used=now_iso,
-                updated_at=datetime.now(),
+                usage_count=Instructions.usage_count + Case(
+                    Instructions.id, list(counts.items()), 0
+                ),
+                last_used=now.isoformat(),
+                updated_at=now,
             )
-            .where(Instructions.id == instruction_id)
+            .where(Instructions.id.in_(list(counts)))
             .execute()
         )
 
+    def get_instruction_rating_counts(self, instruction_id):
+        """Счётчики лайков/дизлайков инструкции (без чтения JSON-колонок)"""
+        return (
+            Instructions
+            .select(Instructions.likes, Instructions.dislikes)
+            .where(Instructions.id == instruction_id)
+            .dicts()
+            .first()
+        )
+
     def rate_instruction(self, instruction_id, rating, user_session=None):
         """Оценка инструкции (лайк/дизлайк)"""
-        if user_session:
-            exists = (
-                InstructionRatings
-                .select()
-                .where(
-                    (InstructionRatings.instruction_id == instruction_id)
-                    & (InstructionRatings.user_session == user_session)
-                )
-                .exists()
+        # повторная оценка из той же сессии отсекается в самой вставке:
+        # INSERT ... SELECT ... WHERE NOT EXISTS — одним запросом, без
+        # отдельного SELECT. Уникальный индекс (instruction_id, user_session)
+        # создаёт analyzer.py и на старой БД его может не быть; если он есть,
+        # OR IGNORE дополнительно закрывает гонку параллельных запросов
+        already_rated = (
+            InstructionRatings
+            .select(SQL("1"))
+            .where(
+                (InstructionRatings.instruction_id == instruction_id)
+                & (InstructionRatings.user_session == user_session)
             )
-            if exists:
-                return False, "Вы уже оценили эту инструкцию"
-
-        InstructionRatings.create(
-            instruction_id=instruction_id,
-            rating=rating,
-            user_session=user_session,
         )
-
-        if rating == 1:
-            (
-                Instructions
-                .update(likes=Instructions.likes + 1)
-                .where(Instructions.id == instruction_id)
-                .execute()
-            )
-        else:
-            (
-                Instructions
-                .update(dislikes=Instructions.dislikes + 1)
-                .where(Instructions.id == instruction_id)
-                .execute()
+        row = Select(
+            columns=[Value(instruction_id), Value(rating), Value(user_session)]
+        ).where(~fn.EXISTS(already_rated))
+        inserted = (
+            InstructionRatings
+            .insert_from(
+                row,
+                [
+                    InstructionRatings.instruction_id,
+                    InstructionRatings.rating,
+                    InstructionRatings.user_session,
+                ],
             )
+            .on_conflict_ignore()
+            .as_rowcount()
+            .execute()
+        )
+        if not inserted:
+            return False, "Вы уже оценили эту инструкцию"
+        # likes/dislikes входят в закэшированную инструкцию
+        self._instructions_by_task.discard_if(
+            lambda instruction: instruction["id"] == instruction_id
+        )
 
         return True, "Оценка сохранена"
 
@@ -284,43 +649,176 @@ class DatabaseManager:
         return ratings
 
     def get_popular_instructions(self, limit=10):
-        """Получение популярных инструкций"""
+        """Получение популярных инструкций (генератор: строки читаются из курсора по одной)"""
         query = (
             Instructions
-            .select()
-            .order_by((Instructions.usage_count + Instructions.likes * 5).desc())
+            .select(*INSTRUCTION_LIST_FIELDS)
+            # множитель — литерал SQL, а не параметр: иначе выражение не совпадёт
+            # с индексом idx_instructions_popularity и SQLite отсортирует всю таблицу
+            .order_by((Instructions.usage_count + Instructions.likes * SQL("5")).desc())
             .limit(limit)
         )
-        return [self._row_to_instruction_dict(row) for row in query]
+        return (self._row_to_instruction_dict(row, with_context=False) for row in query.iterator())
 
     def search_instructions(self, query):
-        """Поиск инструкций по запросу"""
-        pattern = f"%{query}%"
-        q = (
-            Instructions
-            .select()
-            .where(
+        """Поиск инструкций по запросу (генератор: строки читаются из курсора по одной)"""
+        # trigram-индекс находит подстроки от 3 символов: запрос передаём
+        # одной фразой, чтобы совпадение было как у LIKE '%q%'
+        if self.has_fts and len(query) >= 3:
+            phrase = '"' + query.replace('"', '""') + '"'
+            condition = Instructions.id.in_(SQL(
+                "(SELECT instruction_id FROM instructions_fts WHERE instructions_fts MATCH ?)",
+                [phrase],
+            ))
+        else:
+            pattern = f"%{query}%"
+            condition = (
                 (Instructions.task_id ** pattern)
                 | (Instructions.user_query ** pattern)
                 | (Instructions.task_data_json ** pattern)
                 | (Instructions.steps_json ** pattern)
             )
+        q = (
+            Instructions
+            .select(*INSTRUCTION_LIST_FIELDS)
+            .where(condition)
             .order_by(Instructions.usage_count.desc())
         )
-        return [self._row_to_instruction_dict(row) for row in q]
+        return (self._row_to_instruction_dict(row, with_context=False) for row in q.iterator())
 
     def save_chat_message(self, session_id, message_text, message_type, instruction_id=None):
-        """Сохранение сообщения чата в историю"""
-        ChatHistory.create(
-            session_id=session_id,
-            message_text=message_text,
-            message_type=message_type,
-            instruction_id=instruction_id,
-            created_at=datetime.now(),
-        )
+        """
+        Сохранение сообщения чата в историю. Пока работает фоновая запись
+        (start_chat_writer), сообщение ставится в очередь и запрос не ждёт
+        коммита; без неё — пишется сразу. Время берётся в момент вызова,
+        поэтому порядок истории не зависит от момента записи
+        """
+        row = {
+            "session_id": session_id,
+            "message_text": message_text,
+            "message_type": message_type,
+            "instruction_id": instruction_id,
+            "created_at": datetime.now(),
+        }
+        if self._chat_writer is None:
+            ChatHistory.insert(**row).execute()
+        else:
+            self._chat_queue.put_nowait(row)
+
+    def start_chat_writer(self, batch_size=500, retry_delay=1.0):
+        """
+        Запускает фоновую запись истории чата: поток ждёт первое сообщение,
+        забирает всё, что накопилось в очереди (не больше batch_size),
+        и пишет пачку одной транзакцией. Сообщения, не записанные из-за
+        временной ошибки (БД занята анализатором), возвращаются в очередь
+        и пишутся повторно через retry_delay секунд
+        """
+        def loop():
+            while True:
+                batch = [self._chat_queue.get()]
+                batch.extend(self._drain_chat_queue(batch_size - 1))
+                stopping = any(row is CHAT_WRITER_STOP for row in batch)
+                rows = [row for row in batch if row is not CHAT_WRITER_STOP]
+                try:
+                    failed = self._write_chat_batch(rows) if rows else []
+                except Exception as e:
+                    logger.error(f"Error writing {len(rows)} chat messages: {str(e)}")
+                    failed = []
+                if stopping:
+                    # при остановке очередь больше не разбирается: несколько
+                    # попыток здесь же, затем сообщения теряются
+                    for _ in range(3):
+                        if not failed:
+                            break
+                        time.sleep(retry_delay)
+                        failed = self._write_chat_batch(failed)
+                    if failed:
+                        logger.error(f"Lost {len(failed)} chat messages on shutdown")
+                    return
+                if failed:
+                    for row in failed:
+                        self._chat_queue.put_nowait(row)
+                    time.sleep(retry_delay)
+
+        self._chat_writer = threading.Thread(target=loop, name="chat-writer", daemon=True)
+        self._chat_writer.start()
+        # оставшиеся сообщения записываются при остановке
+        atexit.register(self.flush_chat_messages)
+
+    def flush_chat_messages(self, timeout=30):
+        """
+        Записывает все ожидающие сообщения. Фоновый поток останавливается
+        меткой в конце очереди: так он дописывает и пачку, которую уже взял
+        из очереди, а не теряет её при выходе
+        """
+        writer = self._chat_writer
+        if writer is not None and writer.is_alive():
+            self._chat_queue.put_nowait(CHAT_WRITER_STOP)
+            writer.join(timeout)
+            if writer.is_alive():
+                logger.error("Chat writer did not stop in time")
+                return
+            # дальше сообщения пишутся сразу
+            self._chat_writer = None
+        rows = [row for row in self._drain_chat_queue() if row is not CHAT_WRITER_STOP]
+        failed = self._write_chat_batch(rows) if rows else []
+        if failed:
+            logger.error(f"Lost {len(failed)} chat messages on shutdown")
+
+    def _drain_chat_queue(self, limit=None):
+        """Забирает из очереди без ожидания до limit сообщений (None — все)"""
+        batch = []
+        while limit is None or len(batch) < limit:
+            try:
+                batch.append(self._chat_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_chat_batch(self, batch):
+        """
+        Пишет пачку сообщений одной транзакцией. Если пачку отвергла одна
+        строка (нарушение ограничения), сообщения пишутся по одному и
+        отбрасываются только негодные. Возвращает сообщения, не записанные
+        из-за временной ошибки (database is locked), для повторной попытки
+        """
+        try:
+            with db.connection_context():
+                with db.atomic():
+                    for rows in chunked(batch, 100):
+                        ChatHistory.insert_many(rows).execute()
+            return []
+        except OperationalError as e:
+            logger.warning(f"Chat messages not written, will retry: {str(e)}")
+            return batch
+        except IntegrityError:
+            pass
+
+        failed = []
+        with db.connection_context():
+            for row in batch:
+                try:
+                    ChatHistory.insert(**row).execute()
+                except IntegrityError as e:
+                    logger.error(
+                        f"Dropping chat message for session {row['session_id']}: {str(e)}"
+                    )
+                except OperationalError:
+                    failed.append(row)
+        return failed
 
     def get_chat_history(self, session_id, limit=50):
-        """Получение истории чата для сессии"""
+        """
+        Получение истории чата для сессии: последние limit сообщений
+        в порядке возрастания времени (генератор)
+        """
+        latest_ids = (
+            ChatHistory
+            .select(ChatHistory.id)
+            .where(ChatHistory.session_id == session_id)
+            .order_by(ChatHistory.created_at.desc())
+            .limit(limit)
+        )
         q = (
             ChatHistory
             .select(
@@ -329,64 +827,69 @@ class DatabaseManager:
                 ChatHistory.instruction_id,
                 ChatHistory.created_at,
             )
-            .where(ChatHistory.session_id == session_id)
-            .order_by(ChatHistory.created_at.desc())
-            .limit(limit)
+            .where(ChatHistory.id.in_(latest_ids))
+            .order_by(ChatHistory.created_at)
         )
-        rows = list(q)
-        # вернуть список dict как раньше
-        result = [
+        return (
             {
                 "message_text": r.message_text,
                 "message_type": r.message_type,
                 "instruction_id": r.instruction_id,
                 "created_at": r.created_at,
             }
-            for r in rows
-        ]
-        return result
+            for r in q.iterator()
+        )
 
     def create_user_session(self, session_id, user_agent=None, ip_address=None):
-        """Создание новой пользовательской сессии"""
+        """Создание сессии или обновление активности существующей (один UPSERT)"""
         UserSessions.insert(
             session_id=session_id,
             user_agent=user_agent,
             ip_address=ip_address,
-            last_activity=datetime.now(),
-        ).on_conflict_replace().execute()
-
-    def update_session_activity(self, session_id):
-        """Обновление времени последней активности сессии"""
-        (
-            UserSessions
-            .update(last_activity=datetime.now())
-            .where(UserSessions.session_id == session_id)
-            .execute()
-        )
-
-    def _row_to_instruction_dict(self, row):
+            # время ставит SQLite — как и DEFAULT CURRENT_TIMESTAMP у created_at
+            last_activity=SQL("CURRENT_TIMESTAMP"),
+        ).on_conflict(
+            conflict_target=[UserSessions.session_id],
+            preserve=[
+                UserSessions.user_agent,
+                UserSessions.ip_address,
+                UserSessions.last_activity,
+            ],
+        ).execute()
+
+    def _row_to_instruction_dict(self, row, with_context=True):
         """Преобразование строки БД в словарь инструкции"""
         # row здесь — объект Instructions
-        return {
+        result = {
             "id": row.id,
             "task_id": row.task_id,
-            "task_data": json.loads(row.task_data_json) if row.task_data_json else {},
-            "steps": json.loads(row.steps_json) if row.steps_json else [],
+            "task_data": load_json_field(row.task_data_json) if row.task_data_json else {},
+            "steps": load_json_field(row.steps_json) if row.steps_json else [],
             "user_query": row.user_query,
-            "context": json.loads(row.context_json) if row.context_json else {},
             "timestamp": row.timestamp,
             "usage_count": row.usage_count,
             "last_used": row.last_used,
-            "file_paths": json.loads(row.file_paths_json) if row.file_paths_json else {},
+            "file_paths": load_json_field(row.file_paths_json) if row.file_paths_json else {},
             "likes": row.likes,
             "dislikes": row.dislikes,
             "created_at": row.created_at,
             "updated_at": row.updated_at,
         }
+        if with_context:
+            result["context"] = load_json_field(row.context_json) if row.context_json else {}
+        return result
 
 
 # ==================== Instruction Assistant Manager ====================
 
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """Ключ запроса: без регистра и лишних пробелов ("Как  оплатить?" == "как оплатить?")"""
+    return WHITESPACE_RE.sub(" ", text.strip().lower())
+
+
 class AssistantManager:
     """Менеджер для работы с InstructionAssistant"""
     
@@ -395,6 +898,13 @@ class AssistantManager:
         self.api_key = api_key
         self.assistant: InstructionAssistant = None
         self.instructions_loaded = False
+        # Запросы, которые сейчас обрабатываются: текст запроса -> Future с ответом
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Ограничивает число одновременных поисков, чтобы не перегружать CPU
+        self._search_slots = threading.BoundedSemaphore(MAX_CONCURRENT_SEARCHES)
+        # Готовые ответы: текст запроса -> (time.monotonic() ответа, результат), LRU
+        self._answers = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
         self._load_instructions()
     
     def _load_instructions(self):
@@ -413,6 +923,9 @@ class AssistantManager:
             self.assistant = InstructionAssistant(api_key=self.api_key)
             self.assistant.load_instructions(intent_data['instructions'])
             
+            # ответы по прежнему набору инструкций больше не актуальны
+            self._answers.clear()
+            
             self.instructions_loaded = True
             logger.info("✅ InstructionAssistant initialized successfully")
             return True
@@ -432,6 +945,44 @@ class AssistantManager:
                     'message': 'Инструкции не загружены. Система инициализируется...'
                 }
         
+        # запросы, отличающиеся только регистром и пробелами, — один запрос
+        user_query = normalize_query(user_query)
+        
+        cached = self._answers.get(user_query)
+        if cached is not None:
+            logger.info(f"Answer cache hit: '{user_query}'")
+            return cached
+        
+        # Одинаковые запросы, пришедшие одновременно, обрабатываются один раз:
+        # остальные ждут результата первого вместо повторного поиска и вызовов LLM
+        with self._inflight_lock:
+            future = self._inflight.get(user_query)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._inflight[user_query] = future
+        
+        if not is_owner:
+            logger.info(f"Query already in progress, waiting for result: '{user_query}'")
+            return future.result()
+        
+        try:
+            with self._search_slots:
+                result = self._search_answer(user_query)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            if result.get('status') != 'error':
+                self._answers.set(user_query, result)
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(user_query, None)
+    
+    def _search_answer(self, user_query: str) -> dict:
+        """Поиск ответа через InstructionAssistant"""
         try:
             logger.info(f"Processing query: '{user_query}'")
             
@@ -457,6 +1008,27 @@ class AssistantManager:
 
 # ==================== AI Service ====================
 
+# Готовые ответы на типовые фразы. Все фразы собраны в одно регулярное
+# выражение, которое строится один раз при импорте: сообщение просматривается
+# за один проход. Срабатывает фраза, встретившаяся в сообщении раньше; на одной
+# позиции более длинная (специфичная) фраза проверяется первой.
+CHAT_RESPONSES = tuple(sorted(
+    {
+        "привет": "Привет! Я ваш AI-ассистент. Чем могу помочь?",
+        "помощь": "Я помогу вам разобраться с интерфейсом. Просто спросите, как выполнить нужное действие.",
+        "как работает": "Задайте конкретный вопрос о том, что вы хотите сделать, и я помогу вам пошагово.",
+    }.items(),
+    key=lambda item: -len(item[0])
+))
+CHAT_RESPONSES_RE = re.compile("|".join(
+    f"(?P<k{i}>{re.escape(key)})" for i, (key, _) in enumerate(CHAT_RESPONSES)
+))
+CHAT_RESPONSES_BY_GROUP = {f"k{i}": response for i, (_, response) in enumerate(CHAT_RESPONSES)}
+# Сообщение, целиком совпадающее с фразой («привет», «помощь»), находится
+# одним обращением к словарю, без прохода регулярного выражения
+CHAT_RESPONSES_EXACT = dict(CHAT_RESPONSES)
+
+
 class AIService:
     """Вспомогательный сервис для текстовых ответов"""
     
@@ -465,34 +1037,51 @@ class AIService:
     
     def chat_response(self, message):
         """Генерация текстового ответа на вопрос (fallback)"""
-        responses = {
-            "привет": "Привет! Я ваш AI-ассистент. Чем могу помочь?",
-            "помощь": "Я помогу вам разобраться с интерфейсом. Просто спросите, как выполнить нужное действие.",
-            "как работает": "Задайте конкретный вопрос о том, что вы хотите сделать, и я помогу вам пошагово.",
-        }
-        
         message_lower = message.lower()
-        for key in responses:
-            if key in message_lower:
-                return responses[key]
+        response = CHAT_RESPONSES_EXACT.get(normalize_query(message_lower))
+        if response is not None:
+            return response
+
+        match = CHAT_RESPONSES_RE.search(message_lower)
+        if match:
+            return CHAT_RESPONSES_BY_GROUP[match.lastgroup]
         
         return "Я понял ваш вопрос. Уточните, пожалуйста, что именно вы хотите сделать?"
 
 
 # ==================== Initialization ====================
 
+# сессии, записанные в БД за последние SESSION_TOUCH_TTL секунд
+_touched_sessions = TTLCache(SESSION_CACHE_SIZE, SESSION_TOUCH_TTL)
+
+
 def get_user_session():
     """Получение или создание пользовательской сессии"""
-    session_id = request.headers.get('X-Session-ID') or str(uuid.uuid4())
+    session_id = request.headers.get('X-Session-ID') or secrets.token_urlsafe(16)
     user_agent = request.headers.get('User-Agent', '')
     ip_address = request.remote_addr
     
+    # сессию, записанную в последние SESSION_TOUCH_TTL секунд, не трогаем:
+    # активная вкладка шлёт запросы подряд, и каждый UPSERT был бы записью в БД
+    if _touched_sessions.get(session_id):
+        return session_id
+    
     db_manager.create_user_session(session_id, user_agent, ip_address)
-    db_manager.update_session_activity(session_id)
+    _touched_sessions.set(session_id, True)
     
     return session_id
 
 
+def _planner_stats_loop():
+    """Фоновое обновление статистики планировщика раз в DB_ANALYZE_INTERVAL"""
+    while True:
+        time.sleep(DB_ANALYZE_INTERVAL)
+        try:
+            db_manager.refresh_planner_stats()
+        except Exception as e:
+            logger.error(f"Error refreshing planner stats: {str(e)}")
+
+
 # Инициализация сервисов
 db_manager = DatabaseManager(DATABASE_PATH)
 
@@ -508,6 +1097,67 @@ assistant_manager = AssistantManager(db_manager=db_manager, api_key=api_key)
 # Вспомогательный сервис
 ai_service = AIService(db_manager=db_manager)
 
+# Соединение, открытое при инициализации, возвращаем в пул
+db.close()
+
+
+@app.before_request
+def _db_connect():
+    """Берет соединение из пула на время запроса"""
+    db.connect(reuse_if_open=True)
+
+
+@app.teardown_request
+def _db_close(exc):
+    """Возвращает соединение в пул после запроса"""
+    if not db.is_closed():
+        db.close()
+
+
+def splice_raw_json(fields, **raw_fields):
+    """
+    Сериализует fields и вставляет уже готовые JSON-значения из raw_fields
+    как есть (ключ -> строка JSON) — без разбора и повторной сериализации.
+    """
+    head = app.json.dumps(fields)
+    raw = ", ".join(f'"{key}": {value}' for key, value in raw_fields.items())
+    return f'{head[:-1]}, {raw}}}'
+
+
+def raw_json_response(body):
+    """Ответ с уже сериализованным JSON-телом"""
+    return app.response_class(body, mimetype="application/json")
+
+
+def stream_json_list(list_key, items, count_key="count", fields=None, prefetch=STREAM_PREFETCH):
+    """
+    Потоковый ответ {**fields, "<list_key>": [...], "<count_key>": N}:
+    элементы сериализуются и отправляются по одному, счётчик дописывается
+    в конце. Контекст запроса (и соединение с БД из пула) живёт до конца
+    отправки.
+
+    Первые prefetch элементов (None — все) читаются до возврата ответа:
+    запрос к БД выполняется здесь, и его ошибка доходит до обработчика
+    эндпоинта (ответ 500), а не обрывает уже начатый ответ 200
+    """
+    items = iter(items)
+    first = list(items if prefetch is None else islice(items, prefetch))
+    head = f'{app.json.dumps(fields)[:-1]}, ' if fields else '{'
+
+    def generate():
+        yield f'{head}"{list_key}": ['
+        count = 0
+        try:
+            for item in chain(first, items):
+                yield ("," if count else "") + app.json.dumps(item)
+                count += 1
+        except Exception as e:
+            logger.error(f"Error streaming {list_key}: {str(e)}")
+            raise
+        yield f'], "{count_key}": {count}}}'
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/json")
+
 
 # ==================== API ENDPOINTS ====================
 
@@ -515,8 +1165,7 @@ ai_service = AIService(db_manager=db_manager)
 def health_check():
     """Health-check endpoint"""
     try:
-        tasks_tree = db_manager.get_latest_tasks_tree()
-        is_initialized = bool(tasks_tree)
+        is_initialized = db_manager.has_tasks_tree()
         
         return jsonify({
             'status': 'ok',
@@ -537,11 +1186,13 @@ def health_check():
 def get_tasks_tree():
     """Получение дерева задач"""
     try:
-        tasks_tree = db_manager.get_latest_tasks_tree()
+        tasks_tree = db_manager.get_latest_tasks_tree_raw()
         if not tasks_tree:
             return jsonify({'error': 'Tasks tree not found. Please run analyzer first.'}), 404
         
-        return jsonify({"tasks_tree": tasks_tree})
+        tasks_json = tasks_tree.pop("tasks_json")
+        tree_json = splice_raw_json(tasks_tree, tasks=tasks_json)
+        return raw_json_response(f'{{"tasks_tree": {tree_json}}}')
     
     except Exception as e:
         logger.error(f"Error getting tasks tree: {str(e)}")
@@ -558,13 +1209,17 @@ def get_help():
         data = request.json or {}
         
         # Получаем доступные задачи из дерева задач
-        tasks_tree = db_manager.get_latest_tasks_tree()
-        available_tasks = tasks_tree.get("tasks", [])
+        tasks_tree = db_manager.get_latest_tasks_tree_raw()
+        if not tasks_tree:
+            return jsonify({
+                'available_tasks': [],
+                'application': "Unknown Application"
+            })
         
-        return jsonify({
-            'available_tasks': available_tasks,
-            'application': tasks_tree.get("application", "Unknown Application")
-        })
+        return raw_json_response(splice_raw_json(
+            {'application': tasks_tree["application"]},
+            available_tasks=tasks_tree["tasks_json"]
+        ))
     
     except Exception as e:
         logger.error(f"Error getting help: {str(e)}")
@@ -583,38 +1238,35 @@ def get_instruction():
             return jsonify({"error": "task_id is required"}), 400
         
         # Получаем задачу из дерева задач
-        tasks_tree = db_manager.get_latest_tasks_tree()
-        task_data = None
-        
-        for task in tasks_tree.get("tasks", []):
-            if task["id"] == task_id:
-                task_data = task
-                break
+        task_data = db_manager.get_task(task_id)
         
         if not task_data:
             return jsonify({"error": "Task not found"}), 404
         
         # Ищем инструкцию в БД
-        instruction = db_manager.get_instruction_by_task_id(task_id)
+        instruction = db_manager.get_instruction_by_task_id_raw(task_id)
         
         if instruction:
-            db_manager.update_instruction_usage(instruction['id'])
+            db_manager.record_instruction_usage(instruction['id'])
             db_manager.save_chat_message(
                 session_id,
-                f"Запрос инструкции: {task_data['name']}",
+                f"Запрос инструкции: {task_data['task_name']}",
                 'user',
                 instruction['id']
             )
             
-            return jsonify({
-                'steps': instruction['steps'],
-                'instruction_id': instruction['id'],
-                'task_data': task_data,
-                'file_paths': instruction['file_paths'],
-                'source': 'database',
-                'likes': instruction['likes'],
-                'dislikes': instruction['dislikes']
-            })
+            # steps/file_paths уже хранятся в JSON — отдаём их без разбора
+            return raw_json_response(splice_raw_json(
+                {
+                    'instruction_id': instruction['id'],
+                    'task_data': task_data,
+                    'source': 'database',
+                    'likes': instruction['likes'],
+                    'dislikes': instruction['dislikes']
+                },
+                steps=instruction['steps_json'],
+                file_paths=instruction['file_paths_json']
+            ))
         
         return jsonify({
             'error': 'Instruction not found for this task',
@@ -714,7 +1366,7 @@ def get_instruction_ratings_endpoint(instruction_id):
     """Получение оценок инструкции"""
     try:
         ratings = db_manager.get_instruction_ratings(instruction_id)
-        instruction = db_manager.get_instruction(instruction_id)
+        instruction = db_manager.get_instruction_rating_counts(instruction_id)
         
         if not instruction:
             return jsonify({'error': 'Instruction not found'}), 404
@@ -741,10 +1393,8 @@ def get_popular_instructions():
         limit = request.args.get('limit', 10, type=int)
         instructions = db_manager.get_popular_instructions(limit)
         
-        return jsonify({
-            'count': len(instructions),
-            'instructions': instructions
-        })
+        # список ограничен limit — читается целиком до отправки
+        return stream_json_list('instructions', instructions, prefetch=None)
     
     except Exception as e:
         logger.error(f"Error getting popular instructions: {str(e)}")
@@ -762,11 +1412,7 @@ def search_instructions():
         
         instructions = db_manager.search_instructions(query)
         
-        return jsonify({
-            'query': query,
-            'count': len(instructions),
-            'instructions': instructions
-        })
+        return stream_json_list('instructions', instructions, fields={'query': query})
     
     except Exception as e:
         logger.error(f"Error searching instructions: {str(e)}")
@@ -780,13 +1426,12 @@ def get_chat_history():
         session_id = get_user_session()
         limit = request.args.get('limit', 50, type=int)
         history = db_manager.get_chat_history(session_id, limit)
-        history.reverse()  # Возвращаем в порядке возрастания времени
         
-        return jsonify({
-            'session_id': session_id,
-            'message_count': len(history),
-            'messages': history
-        })
+        return stream_json_list(
+            'messages', history,
+            count_key='message_count',
+            fields={'session_id': session_id},
+        )
     
     except Exception as e:
         logger.error(f"Error getting chat history: {str(e)}")
@@ -814,9 +1459,17 @@ def main():
     logger.info(" - GET /api/popular-instructions - Get popular instructions")
     logger.info(" - GET /api/search-instructions?q=query - Search instructions")
     logger.info(" - GET /api/chat-history - Get chat history")
+    logger.info(f"WSGI threads: {WSGI_THREADS}")
     logger.info("=" * 60)
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    db_manager.refresh_planner_stats()
+    threading.Thread(target=_planner_stats_loop, name="planner-stats", daemon=True).start()
+    db_manager.start_usage_flusher(USAGE_FLUSH_INTERVAL)
+    db_manager.start_chat_writer()
+    
+    # waitress вместо dev-сервера Flask: многопоточный, работает и на Windows
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=5000, threads=WSGI_THREADS)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+# db_common.py - Общие настройки SQLite для analyzer.py и assistant_api.py
+
+# PRAGMA для каждого соединения. Оба процесса работают с одним файлом БД,
+# поэтому настройки должны совпадать
+SQLITE_PRAGMAS = {
+    "foreign_keys": 1,
+    # WAL: API читает, пока анализатор пишет, а чтения не ждут записей
+    # оценок/чата; NORMAL — fsync только на чекпойнте WAL, а не на каждый коммит
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    # 64 МБ кэша страниц на соединение, временные таблицы в памяти,
+    # чтение файла БД через mmap без копирования страниц
+    "cache_size": -64000,
+    "temp_store": "memory",
+    "mmap_size": 268435456,
+}
+
+# Счётчики likes/dislikes в instructions ведёт сама БД: при вставке и удалении
+# оценки. Создаются и анализатором, и API при старте (IF NOT EXISTS), так что
+# на любой БД оценка учитывается ровно один раз
+RATING_COUNT_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS instruction_ratings_count_insert "
+    "AFTER INSERT ON instruction_ratings BEGIN "
+    "UPDATE instructions SET likes = likes + (new.rating = 1), "
+    "dislikes = dislikes + (new.rating != 1) WHERE id = new.instruction_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS instruction_ratings_count_delete "
+    "AFTER DELETE ON instruction_ratings BEGIN "
+    "UPDATE instructions SET likes = likes - (old.rating = 1), "
+    "dislikes = dislikes - (old.rating != 1) WHERE id = old.instruction_id; "
+    "END",
+)
@@ -31,6 +31,13 @@ def download_urls(urls, html_dir="html_files"):
     
     return downloaded_files
 
+def save_file_list(html_files, temp_file="temp_files.json"):
+    """Сохраняет пути скачанных файлов для dom_parser.js (можно импортировать)"""
+    # кодируем целиком и пишем одним вызовом, а не кусками из json.dump
+    data = json.dumps(html_files, ensure_ascii=False, indent=2).encode("utf-8")
+    with open(temp_file, "wb") as f:
+        f.write(data)
+
 if __name__ == "__main__":
     # Устанавливаем кодировку для вывода в консоль
     if sys.platform.startswith('win'):
@@ -44,8 +51,6 @@ if __name__ == "__main__":
     html_files = download_urls(urls)
     
     # Сохраняем пути в временный файл с UTF-8 кодировкой
-    temp_file = "temp_files.json"
-    with open(temp_file, "w", encoding="utf-8") as f:
-        json.dump(html_files, f, ensure_ascii=False, indent=2)
+    save_file_list(html_files)
     
     print("HTML files downloaded successfully")
\ No newline at end of file
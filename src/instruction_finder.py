@@ -1,7 +1,7 @@
 from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass, asdict
-import json
 import logging
+import orjson
 import requests
 import numpy as np
 import faiss
@@ -9,12 +9,23 @@ from sentence_transformers import SentenceTransformer
 from pathlib import Path
 import pickle
 import hashlib
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from llm_http import LLM_POOL_MAXSIZE, llm_http_adapter
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Потоки для оценки кандидатов через LLM. Работа ждёт сеть, а не CPU,
+# поэтому потоков больше, чем ядер; не больше пула HTTP-соединений
+LLM_EVAL_WORKERS = int(os.getenv(
+    "LLM_EVAL_WORKERS", min(LLM_POOL_MAXSIZE, (os.cpu_count() or 1) * 8)
+))
+
 
 # ==================== Data Models ====================
 
@@ -237,6 +248,14 @@ class LLMClient:
         self.base_url: str = base_url
         self.model: str = model
         self.timeout: int = timeout
+        # Общая сессия держит keep-alive соединения к API между вызовами;
+        # заголовки не меняются, поэтому задаются один раз
+        self.session: requests.Session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        })
+        self.session.mount("https://", llm_http_adapter())
             
     def call_api(self, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
         """Низкоуровневый вызов API"""
@@ -247,21 +266,15 @@ class LLMClient:
             "temperature": temperature,
         }
         
-        headers: Dict[str, str] = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-        
         try:
-            response: requests.Response = requests.post(
+            response: requests.Response = self.session.post(
                 self.base_url,
-                headers=headers,
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=self.timeout,
             )
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             return data["choices"][0]["message"]["content"].strip()
         
         except requests.exceptions.Timeout:
@@ -291,6 +304,8 @@ class InstructionSearchEngine:
         self.vector_store = VectorStore(model_name=vector_model) if use_vector_search else None
         self.use_vector_search = use_vector_search
         self.similarity_threshold = similarity_threshold
+        # Пул для параллельной оценки кандидатов через LLM
+        self.executor = ThreadPoolExecutor(max_workers=LLM_EVAL_WORKERS, thread_name_prefix="llm-eval")
     
     def build_vector_index(self, instructions: List[Dict[str, Any]]):
         """Построение векторного индекса"""
@@ -326,7 +341,7 @@ class InstructionSearchEngine:
             import re
             json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
             if json_match:
-                data = json.loads(json_match.group())
+                data = orjson.loads(json_match.group())
                 score = data.get("relevance_score", 0.0)
                 return float(score) / 100.0 if score > 1 else float(score)
         except:
@@ -390,7 +405,7 @@ class InstructionSearchEngine:
             
             if json_match:
                 try:
-                    data = json.loads(json_match.group())
+                    data = orjson.loads(json_match.group())
                     score = float(data.get("relevance_score", 0.5))
                     found_instruction = str(data.get("instruction", ""))
                     description = str(data.get("description", ""))
@@ -402,7 +417,7 @@ class InstructionSearchEngine:
                     logger.info(f"  ✓ Score: {score:.2f}, Reasoning: {reasoning[:50]}...")
                     return score, reasoning, found_instruction, description
                 
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     logger.warning(f"  ⚠️ Не удалось распарсить JSON из ответа")
                     return 0.5, "Ошибка парсинга ответа API", "", ""
             else:
@@ -434,8 +449,7 @@ class InstructionSearchEngine:
         Returns:
             SearchResult с найденными инструкциями
         """
-        import time
-        start_time = time.time()
+        start_time = time.perf_counter()
         
         logger.info(f"🔍 Начинаю гибридный поиск для запроса: '{user_query}'")
         
@@ -449,7 +463,7 @@ class InstructionSearchEngine:
         
         if not candidates:
             logger.warning("❌ Не найдено кандидатов для оценки")
-            search_time = (time.time() - start_time) * 1000
+            search_time = (time.perf_counter() - start_time) * 1000
             return SearchResult(
                 description="",
                 instruction="",
@@ -471,11 +485,16 @@ class InstructionSearchEngine:
         # Ограничиваем количество кандидатов для оценки LLM
         candidates_to_evaluate = candidates[:min(llm_top_k, len(candidates))]
         
-        for candidate, similarity in candidates_to_evaluate:
-            instruction_text = self._instruction_to_str(candidate)
-            score, reasoning, found_instr, description = self.evaluate_instruction_relevance(
-                user_query, instruction_text
-            )
+        # Оценки независимы друг от друга, поэтому запросы к LLM идут параллельно
+        evaluations = self.executor.map(
+            lambda item: self.evaluate_instruction_relevance(
+                user_query, self._instruction_to_str(item[0])
+            ),
+            candidates_to_evaluate
+        )
+        
+        for (candidate, similarity), evaluation in zip(candidates_to_evaluate, evaluations):
+            score, reasoning, found_instr, description = evaluation
             
             # Комбинированная оценка: учитываем и векторную схожесть, и оценку LLM
             combined_score = (similarity * 0.4) + (score * 0.6)
@@ -487,7 +506,7 @@ class InstructionSearchEngine:
                 best_description = description
                 best_reasoning = reasoning
         
-        search_time = (time.time() - start_time) * 1000
+        search_time = (time.perf_counter() - start_time) * 1000
         
         if best_score < min_relevance:
             logger.warning("❌ Не найдено достаточно релевантных инструкций")
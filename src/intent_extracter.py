@@ -1,8 +1,12 @@
 from typing import Dict, List, Any, Optional
 from dataclasses import dataclass, asdict
 from enum import Enum
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+import os
 import json
 import logging
+import orjson
 import requests
 from pathlib import Path
 
@@ -10,6 +14,9 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Сколько запросов к LLM за инструкциями выполнять параллельно
+INSTRUCTION_WORKERS = int(os.getenv("INSTRUCTION_WORKERS", "8"))
+
 
 # ==================== Enums & Constants ====================
 
@@ -23,6 +30,15 @@ class ActionType(str, Enum):
     SUBMIT = "submit"
 
 
+# Шаблоны текстового описания действий для промпта; ключ — Action.type (str)
+ACTION_FORMATTERS = MappingProxyType({
+    ActionType.NAVIGATE.value: lambda a: f"Перейти на {a.target}",
+    ActionType.CLICK.value: lambda a: f"Кликнуть на '{a.element_text}'",
+    ActionType.SEARCH.value: lambda a: f"Поиск (пример: {a.query_example})",
+    ActionType.FILTER.value: lambda a: f"Фильтр по {', '.join(a.parameters) if a.parameters else 'параметры'}",
+})
+
+
 # ==================== Data Models ====================
 
 @dataclass
@@ -114,12 +130,14 @@ class LLMClient:
         api_key: str,
         model: str = "tngtech/deepseek-r1t2-chimera:free",
         base_url: str = "https://openrouter.ai/api/v1/chat/completions",
-        timeout: int = 120
+        timeout: int = 120,
+        session: Optional[requests.Session] = None
     ):
         self.api_key: str = api_key
         self.base_url: str = base_url
         self.model: str = model
         self.timeout: int = timeout
+        self.session: requests.Session = session or requests.Session()
     
     def generate_instruction(self, prompt: str) -> str:
         """Генерирует инструкцию через API"""
@@ -142,15 +160,15 @@ class LLMClient:
         try:
             logger.info(f"Sending request to {self.base_url} (model: {self.model})")
             
-            response: requests.Response = requests.post(
+            response: requests.Response = self.session.post(
                 self.base_url,
                 headers=headers,
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=self.timeout,
             )
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             instruction_text = data["choices"][0]["message"]["content"].strip()
             
             logger.info("✅ Instruction generated successfully")
@@ -167,6 +185,10 @@ class LLMClient:
         except requests.exceptions.RequestException as e:
             logger.error(f"❌ API request failed: {e}")
             raise RuntimeError(f"API request failed: {str(e)}")
+        
+        except orjson.JSONDecodeError as e:
+            logger.error(f"❌ API returned invalid JSON: {e}")
+            raise RuntimeError(f"API request failed: {str(e)}")
 
 
 # ==================== Task Tree Processor ====================
@@ -174,8 +196,10 @@ class LLMClient:
 class TaskTreeProcessor:
     """Обработчик дерева задач"""
     
-    def __init__(self, llm_client: LLMClient):
+    def __init__(self, llm_client: LLMClient, max_workers: int = INSTRUCTION_WORKERS):
         self.llm_client: LLMClient = llm_client
+        # Сколько инструкций генерировать одновременно (ограничение нагрузки на API)
+        self.max_workers: int = max_workers
         self.total_tasks: int = 0
         self.leaf_tasks: int = 0
     
@@ -211,20 +235,58 @@ class TaskTreeProcessor:
         parent_task_id: Optional[str] = None,
         depth: int = 0
     ) -> List[InstructionResult]:
-        """Рекурсивно генерирует инструкции для листьев дерева"""
-        instructions: List[InstructionResult] = []
+        """
+        Рекурсивно генерирует инструкции для листьев дерева.
+        Дерево обходится последовательно, а запросы к LLM для листьев
+        независимы и выполняются параллельно (не больше max_workers сразу);
+        порядок результатов совпадает с порядком обхода.
+        """
+        leaves: List[tuple] = []
+        self._collect_leaves(node, parent_path, parent_task_id, depth, leaves)
+        
+        if self.max_workers <= 1 or len(leaves) <= 1:
+            return [self._generate_leaf_instruction(*leaf) for leaf in leaves]
+        
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(leaves)),
+            thread_name_prefix="instruction-gen"
+        ) as pool:
+            return list(pool.map(lambda leaf: self._generate_leaf_instruction(*leaf), leaves))
+    
+    def _collect_leaves(
+        self,
+        node: TaskNode,
+        parent_path: str,
+        parent_task_id: Optional[str],
+        depth: int,
+        leaves: List[tuple]
+    ) -> None:
+        """Собирает листья дерева в порядке обхода: (узел, путь родителя, id родителя, глубина)"""
+        if not node.children:
+            leaves.append((node, parent_path, parent_task_id, depth))
+            return
+        
+        full_path: str = f"{parent_path} > {node.task_name}" if parent_path else node.task_name
+        logger.info(f"→ Traversing non-leaf node: {node.task_name} ({len(node.children)} children)")
         
+        for child in node.children:
+            self._collect_leaves(child, full_path, node.task_id, depth + 1, leaves)
+    
+    def _generate_leaf_instruction(
+        self,
+        node: TaskNode,
+        parent_path: str,
+        parent_task_id: Optional[str],
+        depth: int
+    ) -> InstructionResult:
+        """Генерирует инструкцию для одного листа (ошибка LLM попадает в результат)"""
         full_path: str = f"{parent_path} > {node.task_name}" if parent_path else node.task_name
+        logger.info(f"📝 Generating instruction for leaf: {full_path}")
         
-        is_leaf = len(node.children) == 0
+        # Строим контекст из действий
+        actions_context = self._format_actions(node.actions)
         
-        if is_leaf:  # Это лист - генерируем инструкцию
-            logger.info(f"📝 Generating instruction for leaf: {full_path}")
-            
-            # Строим контекст из действий
-            actions_context = self._format_actions(node.actions)
-            
-            prompt: str = f"""Ты — инструктор для пользователей онлайн-сайта. Напиши чёткую пошаговую инструкцию.
+        prompt: str = f"""Ты — инструктор для пользователей онлайн-сайта. Напиши чёткую пошаговую инструкцию.
 
 Название задачи: "{node.task_name}"
 Контекст: {parent_path or 'Главная страница'}
@@ -240,49 +302,35 @@ class TaskTreeProcessor:
 
 Ответ (только шаги, без нумерации и пояснений):
 """
-            
-            try:
-                instruction_text: str = self.llm_client.generate_instruction(prompt)
-                
-                result = InstructionResult(
-                    task_id=node.task_id,
-                    task_name=node.task_name,
-                    full_path=full_path,
-                    depth=depth,
-                    instruction=instruction_text,
-                    is_leaf=True,
-                    parent_task_id=parent_task_id
-                )
-                instructions.append(result)
-                logger.info(f"✅ Instruction generated for: {node.task_id}")
-            
-            except Exception as e:
-                logger.error(f"❌ Failed to generate instruction for {node.task_id}: {e}")
-                # Всё равно добавляем результат с ошибкой
-                result = InstructionResult(
-                    task_id=node.task_id,
-                    task_name=node.task_name,
-                    full_path=full_path,
-                    depth=depth,
-                    instruction=f"[ОШИБКА] Не удалось сгенерировать инструкцию: {str(e)}",
-                    is_leaf=True,
-                    parent_task_id=parent_task_id
-                )
-                instructions.append(result)
         
-        else:  # Рекурсивно обрабатываем детей
-            logger.info(f"→ Traversing non-leaf node: {node.task_name} ({len(node.children)} children)")
+        try:
+            instruction_text: str = self.llm_client.generate_instruction(prompt)
             
-            for child in node.children:
-                child_instructions = self.generate_instructions_recursive(
-                    child,
-                    full_path,
-                    parent_task_id=node.task_id,
-                    depth=depth + 1
-                )
-                instructions.extend(child_instructions)
+            result = InstructionResult(
+                task_id=node.task_id,
+                task_name=node.task_name,
+                full_path=full_path,
+                depth=depth,
+                instruction=instruction_text,
+                is_leaf=True,
+                parent_task_id=parent_task_id
+            )
+            logger.info(f"✅ Instruction generated for: {node.task_id}")
+            return result
         
-        return instructions
+        except Exception as e:
+            logger.error(f"❌ Failed to generate instruction for {node.task_id}: {e}")
+            # Всё равно добавляем результат с ошибкой
+            result = InstructionResult(
+                task_id=node.task_id,
+                task_name=node.task_name,
+                full_path=full_path,
+                depth=depth,
+                instruction=f"[ОШИБКА] Не удалось сгенерировать инструкцию: {str(e)}",
+                is_leaf=True,
+                parent_task_id=parent_task_id
+            )
+            return result
     
     @staticmethod
     def _format_actions(actions: List[Action]) -> str:
@@ -292,17 +340,8 @@ class TaskTreeProcessor:
         
         action_strs = []
         for action in actions:
-            if action.type == ActionType.NAVIGATE:
-                action_strs.append(f"Перейти на {action.target}")
-            elif action.type == ActionType.CLICK:
-                action_strs.append(f"Кликнуть на '{action.element_text}'")
-            elif action.type == ActionType.SEARCH:
-                action_strs.append(f"Поиск (пример: {action.query_example})")
-            elif action.type == ActionType.FILTER:
-                params = ", ".join(action.parameters) if action.parameters else "параметры"
-                action_strs.append(f"Фильтр по {params}")
-            else:
-                action_strs.append(f"{action.type}")
+            formatter = ACTION_FORMATTERS.get(action.type)
+            action_strs.append(formatter(action) if formatter else f"{action.type}")
         
         return "; ".join(action_strs)
     
@@ -349,8 +388,8 @@ class TaskTreeProcessor:
 class InstructionGenerator:
     """Основной интерфейс для генерации инструкций"""
     
-    def __init__(self, api_key: str):
-        self.llm_client = LLMClient(api_key=api_key)
+    def __init__(self, api_key: str, session: Optional[requests.Session] = None):
+        self.llm_client = LLMClient(api_key=api_key, session=session)
         self.processor = TaskTreeProcessor(llm_client=self.llm_client)
     
     def generate_from_dict(self, tree_dict: Dict[str, Any]) -> Dict[str, Any]:
@@ -373,7 +412,8 @@ class InstructionGenerator:
 
 def process_instructions_pipeline(
     tree_dict: Optional[Dict[str, Any]] = None,
-    api_key: Optional[str] = None
+    api_key: Optional[str] = None,
+    session: Optional[requests.Session] = None
 ) -> Dict[str, Any]:
     """
     Основная функция для обработки дерева задач
@@ -383,6 +423,7 @@ def process_instructions_pipeline(
         input_file: Путь к JSON-файлу с деревом (если tree_dict не передан)
         output_file: Путь к выходному JSON-файлу с результатом
         api_key: API ключ для LLM (если не передан, читается из окружения)
+        session: HTTP-сессия для переиспользования соединений с API
     
     Returns:
         Словарь с результатом обработки
@@ -401,7 +442,7 @@ def process_instructions_pipeline(
         if not api_key:
             raise ValueError("API key must be provided or set in OPENAI_API_KEY env var")
     
-    generator = InstructionGenerator(api_key=api_key)
+    generator = InstructionGenerator(api_key=api_key, session=session)
     
     if tree_dict is not None:
         logger.info("Using provided tree dictionary")
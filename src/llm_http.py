@@ -0,0 +1,32 @@
+# llm_http.py - Общий HTTP-адаптер для клиентов LLM API
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Сколько keep-alive соединений к одному хосту держит пул: потоки, которые
+# параллельно вызывают API, не должны ждать свободного соединения
+LLM_POOL_MAXSIZE = 20
+
+
+def llm_http_adapter() -> HTTPAdapter:
+    """
+    Адаптер для requests.Session клиентов LLM: пул keep-alive соединений
+    и повтор только при ошибке установки соединения. Запрос к модели платный
+    и неидемпотентный, а после 502/504 или обрыва чтения он мог уже
+    выполниться, поэтому такие ошибки не повторяются
+
+    Returns:
+        Адаптер для session.mount("https://", ...) (HTTPAdapter)
+    """
+    return HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=LLM_POOL_MAXSIZE,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.3,
+        ),
+    )